@@ -0,0 +1,200 @@
+"""
+Previsão de consumo e valor por unidade consumidora.
+
+Um modelo de suavização exponencial (ETS do statsmodels, com sazonalidade anual
+quando há histórico suficiente) é ajustado para cada unidade e métrica em um
+pool de processos compartilhado. Os parâmetros ajustados ficam em um cache LRU
+por unidade e métrica, junto com a impressão digital do histórico usado no
+ajuste, de modo que apenas as unidades com dados novos são reajustadas.
+
+Fica em um módulo separado do streamlit_app.py para que a função executada nos
+processos do pool possa ser importada por eles.
+"""
+import hashlib
+import multiprocessing
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+HORIZONTE_PREVISAO = 12  # meses à frente
+METRICAS_PREVISAO = ('consumo', 'valor')
+NIVEL_CONFIANCA = 0.95
+MIN_MESES_PREVISAO = 12  # meses com fatura necessários para prever (apenas nível e tendência)
+MIN_MESES_SAZONAL = 24  # meses com fatura necessários para incluir a sazonalidade anual
+MAX_FRACAO_INTERPOLADA = 0.25  # acima disso a série é mais interpolação do que dados
+UC_PADRAO = 'Única'  # unidade usada quando o arquivo não informa a unidade consumidora
+MAX_SERIES_SEM_POOL = 8  # abaixo disso, ajustar no próprio processo é mais rápido
+VERSAO_MODELO = 'ets-aad-1'  # alterar invalida os parâmetros em cache
+MAX_MODELOS_EM_CACHE = 50_000  # séries (unidade x métrica) guardadas; poucas centenas de bytes cada
+
+
+class CacheModelos:
+    """
+    Cache LRU dos parâmetros ajustados, por (unidade, métrica). Guarda apenas a impressão
+    digital mais recente de cada série, então o tamanho é limitado pelo número de séries
+    (no máximo max_entradas), e não cresce a cada novo upload ou mês de dados.
+    """
+
+    def __init__(self, max_entradas=MAX_MODELOS_EM_CACHE):
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()  # compartilhado entre as sessões do servidor
+
+    def obter(self, uc, metrica, impressao):
+        with self._lock:
+            entrada = self._entradas.get((uc, metrica))
+            if entrada is None or entrada[0] != impressao:
+                return None
+            self._entradas.move_to_end((uc, metrica))
+            return entrada[1]
+
+    def guardar(self, uc, metrica, impressao, parametros):
+        with self._lock:
+            self._entradas[(uc, metrica)] = (impressao, parametros)
+            self._entradas.move_to_end((uc, metrica))
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def limpar(self):
+        with self._lock:
+            self._entradas.clear()
+
+    def __len__(self):
+        return len(self._entradas)
+
+
+# Função para montar a série mensal (regular) de cada unidade
+def preparar_series(df):
+    """
+    Retorna um dicionário {unidade: DataFrame mensal com consumo e valor}, somando faturas
+    do mesmo mês e interpolando meses ausentes (marcados na coluna 'interpolado')
+    """
+    base = pd.DataFrame({
+        'uc': df['uc'] if 'uc' in df.columns else UC_PADRAO,
+        'data': df['data'],
+        'consumo': df['consumo'].astype(float),
+        'valor': df['valor'].astype(float),
+    })
+    mensal = base.groupby(['uc', 'data'], sort=True)[list(METRICAS_PREVISAO)].sum()
+
+    series = {}
+    for uc, serie_uc in mensal.groupby(level='uc', sort=False):
+        serie_uc = serie_uc.droplevel('uc').asfreq('MS')
+        interpolado = serie_uc['consumo'].isna()
+        serie_uc = serie_uc.interpolate()
+        serie_uc['interpolado'] = interpolado
+        series[uc] = serie_uc
+    return series
+
+
+# Função para calcular a impressão digital do histórico de uma série
+def impressao_digital(serie, metrica, sazonal):
+    h = hashlib.sha1(f'{VERSAO_MODELO}:{metrica}:{sazonal}'.encode('utf-8'))
+    h.update(serie.index.asi8.tobytes())
+    h.update(np.ascontiguousarray(serie.to_numpy(dtype=float)).tobytes())
+    return h.hexdigest()
+
+
+def _criar_modelo(serie, sazonal):
+    from statsmodels.tsa.exponential_smoothing.ets import ETSModel
+
+    if sazonal:
+        return ETSModel(serie, error='add', trend='add', damped_trend=True, seasonal='add', seasonal_periods=12)
+    return ETSModel(serie, error='add', trend='add', damped_trend=True)
+
+
+# Função executada nos processos do pool: ajusta (ou reaproveita) o modelo e prevê
+def _prever_serie(tarefa):
+    uc, metrica, chave, serie, sazonal, parametros, horizonte = tarefa
+    try:
+        modelo = _criar_modelo(serie, sazonal)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # avisos de convergência do otimizador
+            if parametros is None:
+                resultado = modelo.fit(disp=False)
+                parametros = np.asarray(resultado.params)
+            else:
+                resultado = modelo.smooth(parametros)
+            quadro = resultado.get_prediction(
+                start=len(serie), end=len(serie) + horizonte - 1
+            ).summary_frame(alpha=1 - NIVEL_CONFIANCA)
+    except Exception:
+        return uc, metrica, chave, None, None
+
+    previsao = pd.DataFrame({
+        'data': quadro.index,
+        'previsao': quadro['mean'].to_numpy(),
+        'limite_inferior': quadro['pi_lower'].to_numpy(),
+        'limite_superior': quadro['pi_upper'].to_numpy(),
+    })
+    return uc, metrica, chave, parametros, previsao
+
+
+def _contexto_processos():
+    # 'fork' não é seguro no servidor do Streamlit, que roda várias threads
+    metodos = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in metodos else 'spawn')
+
+
+# Função para criar o pool de processos (um único pool deve atender todas as sessões)
+def criar_executor(max_processos=None):
+    return ProcessPoolExecutor(max_workers=max_processos or os.cpu_count() or 1, mp_context=_contexto_processos())
+
+
+# Função principal: previsões de todas as unidades, reaproveitando o cache de modelos
+def prever_unidades(df, cache, horizonte=HORIZONTE_PREVISAO, executor=None):
+    """
+    Retorna (previsoes, resumo): previsoes em formato longo (uc, metrica, data, previsao,
+    limite_inferior, limite_superior) e um resumo com as contagens de modelos ajustados,
+    reaproveitados do cache e que falharam. Sem executor, os modelos são ajustados no
+    próprio processo.
+    """
+    resultados = []
+    tarefas = []
+    resumo = {'ajustados': 0, 'reaproveitados': 0, 'falhas': 0, 'historico_insuficiente': 0}
+
+    for uc, serie_uc in preparar_series(df).items():
+        # O histórico mínimo conta meses com fatura, não meses preenchidos pela interpolação:
+        # poucas faturas espaçadas gerariam uma previsão com intervalo artificialmente estreito
+        meses_com_fatura = int((~serie_uc['interpolado']).sum())
+        if meses_com_fatura < MIN_MESES_PREVISAO or serie_uc['interpolado'].mean() > MAX_FRACAO_INTERPOLADA:
+            resumo['historico_insuficiente'] += 1
+            continue
+        sazonal = meses_com_fatura >= MIN_MESES_SAZONAL
+        for metrica in METRICAS_PREVISAO:
+            serie = serie_uc[metrica]
+            chave = impressao_digital(serie, metrica, sazonal)
+            # Com os parâmetros em cache, só é preciso recalcular a previsão
+            parametros = cache.obter(uc, metrica, chave)
+            tarefas.append((uc, metrica, chave, serie, sazonal, parametros, horizonte))
+
+    if executor is None or len(tarefas) <= MAX_SERIES_SEM_POOL:
+        concluidas = map(_prever_serie, tarefas)
+    else:
+        processos = executor._max_workers  # o ProcessPoolExecutor não expõe esse número publicamente
+        concluidas = executor.map(_prever_serie, tarefas, chunksize=max(1, len(tarefas) // (4 * processos)))
+
+    for (uc, metrica, chave, parametros, previsao), tarefa in zip(concluidas, tarefas):
+        if previsao is None:
+            resumo['falhas'] += 1
+            continue
+        if tarefa[5] is None:
+            resumo['ajustados'] += 1
+            cache.guardar(uc, metrica, chave, parametros)
+        else:
+            resumo['reaproveitados'] += 1
+        resultados.append((uc, metrica, previsao))
+
+    colunas = ['uc', 'metrica', 'data', 'previsao', 'limite_inferior', 'limite_superior']
+    if not resultados:
+        return pd.DataFrame(columns=colunas), resumo
+    previsoes = pd.concat(
+        [previsao.assign(uc=uc, metrica=metrica) for uc, metrica, previsao in resultados],
+        ignore_index=True
+    )
+    return previsoes[colunas], resumo
@@ -6,7 +6,13 @@ import numpy as np
 import plotly.io as pio
 from datetime import datetime
 from millify import prettify
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 import io
+import itertools
+import tempfile
+import warnings
+from previsao import prever_unidades, criar_executor, CacheModelos, HORIZONTE_PREVISAO, NIVEL_CONFIANCA, UC_PADRAO
 
 # Configurar o locale para português brasileiro
 pio.templates.default = "plotly"
@@ -31,6 +37,20 @@ MESES_ABREV_PT = {1: 'Jan', 2: 'Fev', 3: 'Mar', 4: 'Abr',
             9: 'Set', 10: 'Out', 11: 'Nov', 12: 'Dez'
 }
 
+# Configuração das exportações
+TAMANHO_BLOCO_EXPORTACAO = 50_000  # linhas processadas por vez
+LIMITE_MEMORIA_EXPORTACAO = 32 * 2**20  # acima disso o arquivo exportado passa para o disco
+LIMITE_LINHAS_XLSX = 1_048_576  # limite de linhas por aba do Excel (incluindo o cabeçalho)
+COLUNAS_EXPORTACAO_PERIODO = ['mes_ano', 'consumo', 'valor', 'unidade']
+TROCA_SEPARADORES = str.maketrans({',': '.', '.': ','})  # 1,234.56 -> 1.234,56
+
+# Configuração da detecção de anomalias
+JANELA_ANOMALIA = 12  # meses anteriores usados na linha de base móvel
+LIMIAR_Z_ANOMALIA = 3.0  # z-score a partir do qual a fatura é considerada anômala
+LIMIAR_VARIACAO_ANUAL = 0.5  # variação em relação ao mesmo mês do ano anterior (50%)
+ANOS_BASE_SAZONAL = 3  # anos anteriores usados na linha de base sazonal
+METRICAS_ANOMALIA = {'consumo': 'Consumo', 'valor': 'Valor', 'razao': 'Valor/Consumo'}
+
 
 # Função para gerar dicionário de cores por ano
 def gerar_cores_por_ano(anos):
@@ -85,6 +105,15 @@ def processar_dados(file, tipo_conta):
             st.error(f"Colunas obrigatórias ausentes: {', '.join(colunas_faltantes)}")
             return None
         
+        # Coluna opcional de unidade consumidora (arquivos com várias unidades)
+        if 'uc' not in df.columns:
+            for alt in ['unidade_consumidora', 'instalacao', 'instalação', 'codigo_uc', 'inscricao']:
+                if alt in df.columns:
+                    df.rename(columns={alt: 'uc'}, inplace=True)
+                    break
+        if 'uc' in df.columns:
+            df['uc'] = df['uc'].astype(str)
+        
         # Garantir que mês e ano sejam numéricos
         df['mes'] = pd.to_numeric(df['mes'], errors='coerce')
         df['ano'] = pd.to_numeric(df['ano'], errors='coerce')
@@ -166,7 +195,7 @@ def gerar_dados_exemplo(tipo_conta):
     return df
 
 # Função para criar gráfico de linha do tempo
-def criar_grafico_timeline(df, y_column, title, y_label, cores_por_ano):
+def criar_grafico_timeline(df, y_column, title, y_label, cores_por_ano, anomalias=None, previsao=None):
     fig = px.line(
         df, 
         x='data', 
@@ -201,11 +230,13 @@ def criar_grafico_timeline(df, y_column, title, y_label, cores_por_ano):
             )
         )
     )
+    adicionar_marcadores_anomalia(fig, df, 'data', y_column, anomalias)
+    adicionar_faixa_previsao(fig, previsao)
     
     return fig
 
 # Função para criar gráfico de barras
-def criar_grafico_barras(df, y_column, title, y_label, cores_por_ano):
+def criar_grafico_barras(df, y_column, title, y_label, cores_por_ano, anomalias=None):
     # Converter ano para string para compatibilidade com o color_discrete_map
     df = df.copy()
     df['ano_str']=df['ano'].astype(str)
@@ -247,6 +278,7 @@ def criar_grafico_barras(df, y_column, title, y_label, cores_por_ano):
         height=400,
         legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
     )
+    adicionar_marcadores_anomalia(fig, df, 'mes_ano', y_column, anomalias)
 
     return fig
 
@@ -288,16 +320,360 @@ def criar_grafico_comparativo(df, anos_selecionados, y_column, title, y_label, c
 
     return fig
 
+# Função para detectar anomalias em todas as unidades consumidoras
+@st.cache_data
+def detectar_anomalias(df, janela=JANELA_ANOMALIA, limiar_z=LIMIAR_Z_ANOMALIA, limiar_variacao=LIMIAR_VARIACAO_ANUAL):
+    """
+    Varre todas as unidades de uma vez, com operações agrupadas e vetorizadas, e retorna
+    as faturas anômalas ordenadas pela pontuação (mantendo o índice do df original)
+    """
+    metricas = list(METRICAS_ANOMALIA)
+    base = pd.DataFrame({
+        'uc': df['uc'] if 'uc' in df.columns else UC_PADRAO,
+        'data': df['data'],
+        'mes_ano': df['mes_ano'],
+        'mes': df['mes'].astype(int),
+        'ano': df['ano'].astype(int),
+        'consumo': df['consumo'].astype(float),
+        'valor': df['valor'].astype(float),
+    }, index=df.index)
+    base['razao'] = base['valor'] / base['consumo'].where(base['consumo'] != 0)
+    base = base.sort_values(['uc', 'data'], kind='stable')
+
+    # Linha de base móvel: média e desvio das faturas dos últimos `janela` meses de calendário
+    # da mesma unidade. A janela é por tempo (e não por linhas), então meses ausentes não a
+    # estendem para trás, e closed='left' exclui faturas do próprio mês.
+    movel = base.groupby('uc', sort=False).rolling(
+        f'{round(janela * 30.5)}D', on='data', closed='left', min_periods=max(3, janela * 3 // 4)
+    )[metricas]
+    media_movel = pd.DataFrame(movel.mean().to_numpy(), index=base.index, columns=metricas)
+    desvio_movel = pd.DataFrame(movel.std().to_numpy(), index=base.index, columns=metricas)
+
+    # Linha de base sazonal: mediana do mesmo mês nos últimos anos da mesma unidade
+    # (a mediana impede que uma anomalia passada contamine a base dos anos seguintes).
+    # Só valem faturas de anos anteriores, mesmo que a unidade tenha duas faturas no mês.
+    por_mes = base.groupby(['uc', 'mes'], sort=False)
+    mesmos_meses = []
+    variacao = pd.DataFrame(np.nan, index=base.index, columns=['consumo', 'valor'])
+    diferenca_anual = pd.DataFrame(np.nan, index=base.index, columns=['consumo', 'valor'])
+    for k in range(1, ANOS_BASE_SAZONAL + 1):
+        anterior = por_mes[['ano'] + metricas].shift(k)
+        anos_atras = base['ano'] - anterior['ano']
+        mesmos_meses.append(anterior[metricas].where((anos_atras >= 1) & (anos_atras <= ANOS_BASE_SAZONAL), axis=0))
+        # Variação em relação ao mesmo mês do ano anterior (primeira fatura encontrada)
+        ano_anterior = (anos_atras == 1) & variacao['consumo'].isna()
+        variacao.loc[ano_anterior] = (base[['consumo', 'valor']] / anterior[['consumo', 'valor']] - 1)[ano_anterior]
+        diferenca_anual.loc[ano_anterior] = (base[['consumo', 'valor']] - anterior[['consumo', 'valor']])[ano_anterior]
+    variacao = variacao.replace([np.inf, -np.inf], np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # meses sem histórico resultam em NaN
+        media_sazonal = pd.DataFrame(
+            np.nanmedian(np.stack([m.to_numpy() for m in mesmos_meses]), axis=0),
+            index=base.index, columns=metricas
+        )
+
+    # Centro e dispersão vêm da mesma linha de base: a dispersão é o desvio quadrático médio
+    # dos resíduos sazonais (fatura - mediana do mesmo mês) das faturas anteriores da unidade
+    # nos últimos ANOS_BASE_SAZONAL anos. Enquanto não há resíduos suficientes, vale o par
+    # média/desvio da janela móvel.
+    quadrados = ((base[metricas] - media_sazonal) ** 2).assign(uc=base['uc'], data=base['data'])
+    media_quadrados = quadrados.groupby('uc', sort=False).rolling(
+        f'{round(ANOS_BASE_SAZONAL * 365.25)}D', on='data', closed='left', min_periods=max(3, janela * 3 // 4)
+    )[metricas].mean()
+    desvio_residuos = pd.DataFrame(np.sqrt(media_quadrados.to_numpy()), index=base.index, columns=metricas)
+    usa_residuos = desvio_residuos.notna()
+    esperado = media_sazonal.where(usa_residuos, media_movel)
+    desvio = desvio_residuos.where(usa_residuos, desvio_movel)
+    # Desvio mínimo de 5% da média evita z-scores infinitos em séries constantes
+    desvio = desvio.clip(lower=0.05 * media_movel.abs())
+    z = (base[metricas] - esperado) / desvio.where(desvio > 0)
+
+    # Pontuação: z-scores e variações anuais na mesma escala (limiar_z = limite de anomalia).
+    # Um salto anual só pontua se também for grande em relação à dispersão da unidade, para
+    # que séries muito ruidosas não sejam marcadas a cada oscilação.
+    salto_anual = np.minimum(
+        variacao.abs() * limiar_z / limiar_variacao,
+        diferenca_anual.abs() / desvio[['consumo', 'valor']].where(desvio[['consumo', 'valor']] > 0)
+    )
+    criterios = pd.concat([
+        z.abs().add_prefix('z_'),
+        salto_anual.add_prefix('var_anual_'),
+    ], axis=1)
+    pontuacao = criterios.max(axis=1)
+    motivos = {
+        **{f'z_{m}': f'{rotulo} fora da linha de base' for m, rotulo in METRICAS_ANOMALIA.items()},
+        'var_anual_consumo': 'Salto anual do consumo',
+        'var_anual_valor': 'Salto anual do valor',
+    }
+
+    resultado = base[['uc', 'data', 'mes_ano'] + metricas].copy()
+    resultado['esperado_consumo'] = esperado['consumo']
+    resultado['esperado_valor'] = esperado['valor']
+    for m in metricas:
+        resultado[f'z_{m}'] = z[m]
+    resultado['var_anual_consumo'] = variacao['consumo']
+    resultado['var_anual_valor'] = variacao['valor']
+    resultado['pontuacao'] = pontuacao
+    resultado['motivo'] = criterios.fillna(-1).idxmax(axis=1).map(motivos)
+    resultado['anomalia_consumo'] = criterios[['z_consumo', 'var_anual_consumo']].max(axis=1) >= limiar_z
+    resultado['anomalia_valor'] = criterios[['z_valor', 'z_razao', 'var_anual_valor']].max(axis=1) >= limiar_z
+
+    resultado = resultado[pontuacao >= limiar_z]
+    return resultado.sort_values('pontuacao', ascending=False, kind='stable')
+
+# Função para destacar as faturas anômalas em um gráfico
+def adicionar_marcadores_anomalia(fig, df, x_column, y_column, anomalias):
+    if anomalias is None or f'anomalia_{y_column}' not in anomalias.columns:
+        return
+    destacadas = anomalias[anomalias[f'anomalia_{y_column}']]
+    pontos = df.loc[df.index.intersection(destacadas.index)]
+    if pontos.empty:
+        return
+    fig.add_trace(go.Scatter(
+        x=pontos[x_column],
+        y=pontos[y_column],
+        mode='markers',
+        name='Anomalia',
+        marker=dict(size=16, symbol='circle-open', color='red', line=dict(width=3)),
+        customdata=destacadas.loc[pontos.index, 'motivo'],
+        hovertemplate='<b>Anomalia:</b> %{customdata}<extra></extra>'
+    ))
+
+# Cache dos parâmetros dos modelos de previsão, compartilhado entre as sessões
+# (LRU limitado por unidade e métrica; esvaziado com obter_cache_modelos.clear())
+@st.cache_resource
+def obter_cache_modelos():
+    return CacheModelos()
+
+# Pool de processos único, que atende as previsões de todas as sessões
+@st.cache_resource
+def obter_executor_previsao():
+    return criar_executor()
+
+# Função para calcular as previsões de todas as unidades
+@st.cache_data(show_spinner="Ajustando modelos de previsão...", max_entries=8)
+def calcular_previsoes(df, horizonte=HORIZONTE_PREVISAO):
+    """
+    O resultado fica em cache junto com o resumo: as contagens de modelos ajustados e
+    reaproveitados se referem ao momento do cálculo, registrado em 'calculado_em'
+    """
+    executor = obter_executor_previsao()
+    try:
+        previsoes, resumo = prever_unidades(df, obter_cache_modelos(), horizonte, executor)
+    except BrokenProcessPool:
+        # Um processo do pool morreu (falta de memória, por exemplo) e o pool não aceita mais
+        # tarefas: ele é recriado para todas as sessões e o cálculo é refeito uma vez, já
+        # aproveitando os modelos ajustados antes da falha
+        executor.shutdown(wait=False, cancel_futures=True)
+        obter_executor_previsao.clear()
+        previsoes, resumo = prever_unidades(df, obter_cache_modelos(), horizonte, obter_executor_previsao())
+    resumo['calculado_em'] = datetime.now()
+    return previsoes, resumo
+
+# Função para selecionar a previsão de uma unidade e métrica
+def filtrar_previsao(previsoes, uc, metrica):
+    if previsoes is None:
+        return None
+    return previsoes[(previsoes['uc'] == uc) & (previsoes['metrica'] == metrica)]
+
+# Função para sobrepor a previsão e seu intervalo a um gráfico de linha do tempo
+def adicionar_faixa_previsao(fig, previsao):
+    if previsao is None or previsao.empty:
+        return
+    fig.add_trace(go.Scatter(
+        x=previsao['data'],
+        y=previsao['limite_superior'],
+        mode='lines',
+        line=dict(width=0),
+        showlegend=False,
+        hoverinfo='skip'
+    ))
+    fig.add_trace(go.Scatter(
+        x=previsao['data'],
+        y=previsao['limite_inferior'],
+        mode='lines',
+        line=dict(width=0),
+        fill='tonexty',
+        fillcolor='rgba(100, 100, 100, 0.2)',
+        name=f"Intervalo de {NIVEL_CONFIANCA:.0%}",
+        hoverinfo='skip'
+    ))
+    fig.add_trace(go.Scatter(
+        x=previsao['data'],
+        y=previsao['previsao'],
+        mode='lines+markers',
+        name='Previsão',
+        line=dict(dash='dash', color='dimgray'),
+        hovertemplate='<b>Previsão:</b> %{y:,.2f}<extra></extra>'
+    ))
+    # Incluir os meses previstos nos rótulos do eixo x
+    datas = list(fig.layout.xaxis.tickvals or []) + previsao['data'].tolist()
+    rotulos = list(fig.layout.xaxis.ticktext or []) + [f"{MESES_ABREV_PT[d.month]}/{d.year}" for d in previsao['data']]
+    fig.update_xaxes(tickvals=datas, ticktext=rotulos)
+
 # Função para formatar valores monetários
 def formatar_valor(valor):
     return f"{valor:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.')
 
+# Função para somar as faturas de todas as unidades consumidoras em cada mês
+def somar_unidades(df):
+    colunas_mes = [c for c in ['mes', 'ano', 'nome_mes', 'mes_ano', 'unidade', 'tipo_medicao'] if c in df.columns]
+    soma = df.groupby('data', sort=True).agg({
+        **{coluna: 'first' for coluna in colunas_mes},
+        'consumo': 'sum',
+        'valor': 'sum',
+    })
+    return soma.reset_index()
+
+# Função para montar a tabela comparativa (mês x ano) com valores numéricos
+def montar_tabela_comparativa(df, anos_selecionados, y_column, rotulo):
+    # Faturas do mesmo mês (várias unidades ou refaturamentos) são somadas
+    tabela = (
+        df[df['ano'].isin(anos_selecionados)]
+        .pivot_table(index='mes', columns='ano', values=y_column, aggfunc='sum')
+        .reindex(index=range(1, 13), columns=anos_selecionados)
+        .astype(float)
+    )
+    tabela.columns = [f'{rotulo} {ano}' for ano in tabela.columns]
+    tabela.insert(0, 'Mês', [MESES_PT[mes] for mes in tabela.index])
+    return tabela.reset_index(drop=True)
+
+# Funções de exportação (geradas em blocos para limitar o uso de memória)
+#
+# Cada exportador grava o arquivo bloco a bloco em um SpooledTemporaryFile, que passa
+# para o disco quando ultrapassa LIMITE_MEMORIA_EXPORTACAO. O st.download_button lê o
+# arquivo inteiro para servi-lo, então a única cópia completa em memória é a do Streamlit.
+def iterar_blocos(df, colunas=None, tamanho_bloco=TAMANHO_BLOCO_EXPORTACAO):
+    for inicio in range(0, len(df), tamanho_bloco):
+        bloco = df.iloc[inicio:inicio + tamanho_bloco]
+        yield bloco if colunas is None else bloco[colunas]
+
+def formatar_serie_valor(serie):
+    """
+    Formata uma série inteira no padrão de formatar_valor ("N/A" para ausentes)
+    """
+    # A formatação com milhar não tem equivalente vetorizado mais rápido que a lista por
+    # compreensão; a troca de separadores é feita de uma vez na série
+    texto = pd.Series([f"{v:,.2f}" for v in serie.to_numpy(dtype=float).tolist()], index=serie.index, dtype=object)
+    texto = texto.str.translate(TROCA_SEPARADORES)
+    return texto.where(serie.notna(), "N/A")
+
+def formatar_bloco_exportacao(bloco):
+    """
+    Formata as colunas decimais de um bloco no padrão de formatar_valor
+    """
+    bloco = bloco.copy()
+    for coluna in bloco.select_dtypes(include='float').columns:
+        bloco[coluna] = formatar_serie_valor(bloco[coluna])
+    return bloco
+
+def criar_arquivo_exportacao():
+    return tempfile.SpooledTemporaryFile(max_size=LIMITE_MEMORIA_EXPORTACAO)
+
+def exportar_csv(df, colunas=None):
+    arquivo = criar_arquivo_exportacao()
+    arquivo.write('\ufeff'.encode('utf-8'))  # BOM para o Excel reconhecer a acentuação
+    cabecalho = list(df.columns if colunas is None else colunas)
+    arquivo.write((';'.join(map(str, cabecalho)) + '\n').encode('utf-8'))
+    for bloco in iterar_blocos(df, colunas):
+        arquivo.write(formatar_bloco_exportacao(bloco).to_csv(sep=';', index=False, header=False).encode('utf-8'))
+    arquivo.seek(0)
+    return arquivo
+
+def exportar_xlsx(df, colunas=None, nome_aba='Dados'):
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+
+    # Modo write_only grava as linhas em fluxo, sem manter a planilha inteira em memória
+    wb = Workbook(write_only=True)
+    colunas = list(df.columns if colunas is None else colunas)
+    posicoes_decimais = [i for i, tipo in enumerate(df[colunas].dtypes) if pd.api.types.is_float_dtype(tipo)]
+    ws = None
+    celulas_decimais = {}
+    linhas_na_aba = LIMITE_LINHAS_XLSX
+
+    def nova_aba():
+        numero = len(wb.worksheets) + 1
+        aba = wb.create_sheet(nome_aba if numero == 1 else f'{nome_aba} ({numero})')
+        # O Excel só aplica o estilo da coluna a células que não existem no arquivo, então
+        # cada valor decimal é gravado em uma célula com o formato. A célula de cada coluna
+        # é reaproveitada: no modo write_only a linha é gravada assim que é adicionada.
+        for i in posicoes_decimais:
+            celula = WriteOnlyCell(aba)
+            celula.number_format = '#,##0.00'
+            celulas_decimais[i] = celula
+        aba.append([str(coluna) for coluna in colunas])
+        return aba
+
+    if df.empty:
+        nova_aba()
+    for bloco in iterar_blocos(df, colunas):
+        # Valores ausentes viram células vazias
+        bloco = bloco.astype(object).where(bloco.notna(), None)
+        for linha in bloco.itertuples(index=False, name=None):
+            if linhas_na_aba >= LIMITE_LINHAS_XLSX:
+                ws = nova_aba()
+                linhas_na_aba = 1
+            linha = list(linha)
+            for i in posicoes_decimais:
+                if linha[i] is not None:
+                    celulas_decimais[i].value = linha[i]
+                    linha[i] = celulas_decimais[i]
+            ws.append(linha)
+            linhas_na_aba += 1
+
+    arquivo = criar_arquivo_exportacao()
+    wb.save(arquivo)
+    arquivo.seek(0)
+    return arquivo
+
+def exportar_parquet(df, colunas=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Parquet mantém os tipos numéricos; a formatação fica a cargo de quem lê o arquivo
+    arquivo = criar_arquivo_exportacao()
+    blocos = iterar_blocos(df, colunas)
+    primeiro = next(blocos, df.iloc[:0] if colunas is None else df.iloc[:0][colunas])
+    # O esquema vem do primeiro bloco (com um DataFrame vazio, colunas de texto do tipo
+    # object seriam inferidas como nulas); colunas sem nenhum valor no bloco viram texto
+    schema = pa.Table.from_pandas(primeiro, preserve_index=False).schema
+    for i, campo in enumerate(schema):
+        if pa.types.is_null(campo.type):
+            schema = schema.set(i, campo.with_type(pa.string()))
+    with pq.ParquetWriter(arquivo, schema) as writer:
+        for bloco in itertools.chain([primeiro], blocos):
+            writer.write_table(pa.Table.from_pandas(bloco, schema=schema, preserve_index=False))
+    arquivo.seek(0)
+    return arquivo
+
+FORMATOS_EXPORTACAO = {
+    'CSV': (exportar_csv, 'csv', 'text/csv'),
+    'XLSX': (exportar_xlsx, 'xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'Parquet': (exportar_parquet, 'parquet', 'application/vnd.apache.parquet'),
+}
+
+# Função para exibir os botões de exportação de uma tabela
+def exibir_botoes_exportacao(df, nome_arquivo, chave, colunas=None):
+    colunas = st.columns(len(FORMATOS_EXPORTACAO))
+    for coluna, (formato, (exportar, extensao, mime)) in zip(colunas, FORMATOS_EXPORTACAO.items()):
+        with coluna:
+            # O arquivo só é gerado quando o botão é clicado
+            st.download_button(
+                f"⬇️ Exportar {formato}",
+                data=partial(exportar, df, colunas),
+                file_name=f"{nome_arquivo}.{extensao}",
+                mime=mime,
+                key=f"{chave}_{extensao}",
+                on_click='ignore'
+            )
+
 # Interface principal
 def main():
     st.title("📊 Análise de Gastos - MIDR")
     
     # Criação das abas
-    tab1, tab2, tab3, tab4 = st.tabs(['📋 Introdução', '📊 Visão Geral', '🔍 Análise por Período', '🔄 Comparações'])
+    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(['📋 Introdução', '📊 Visão Geral', '🔍 Análise por Período', '🔄 Comparações', '🚨 Anomalias', '🔮 Previsão'])
     
     # Aba 1: Introdução
     with tab1:
@@ -320,6 +696,7 @@ def main():
             ('Conta de água(CAESB)', 'Conta de energia(CEB/Neoenergia)'),
             index=None,
             placeholder="Selecione o tipo de conta...",
+            key="select_conta"
         )
         
         if select_conta is None:
@@ -398,22 +775,42 @@ def main():
     anos = sorted(df['ano'].unique())
     cores_por_ano = gerar_cores_por_ano(anos)
     
+    # Detectar anomalias (limiares definidos na aba de anomalias)
+    limiar_z = st.session_state.get('limiar_anomalia', LIMIAR_Z_ANOMALIA)
+    limiar_variacao = st.session_state.get('limiar_variacao_anual', int(LIMIAR_VARIACAO_ANUAL * 100)) / 100
+    anomalias = detectar_anomalias(df, limiar_z=limiar_z, limiar_variacao=limiar_variacao)
+    
+    # Calcular previsões (somente quando ativadas na aba de previsão)
+    if st.session_state.get('calcular_previsoes', False):
+        previsoes, resumo_previsao = calcular_previsoes(df)
+    else:
+        previsoes, resumo_previsao = None, None
+    unidades_consumidoras = sorted(df['uc'].unique()) if 'uc' in df.columns else [UC_PADRAO]
+    
+    # Com várias unidades, as abas gerais mostram a soma mensal de todas elas; as anomalias
+    # são de cada unidade, então os destaques ficam na aba de anomalias
+    varias_unidades = len(unidades_consumidoras) > 1
+    df_geral = somar_unidades(df) if varias_unidades else df
+    anomalias_geral = None if varias_unidades else anomalias
+    
     # Aba 2: Visão Geral
     with tab2:
         # Confirmação de que os dados estão carregados corretamente
         if 'dados_carregados' not in st.session_state or not st.session_state.dados_carregados:
             st.warning("⚠️ Nenhum dado carregado. Por favor, volte à aba 'Introdução' para carregar dados.")
             st.stop()
-        df = st.session_state.df
+        df = df_geral
         tipo_conta = st.session_state.tipo_conta
         
         st.header("Visão Geral dos Dados")
+        if varias_unidades:
+            st.caption(f"Os valores e gráficos somam, mês a mês, as {len(unidades_consumidoras)} unidades consumidoras do arquivo.")
         
         # Estatísticas gerais
         col1, col2 = st.columns(2)
         
         with col1:
-            st.metric("Total de registros", len(df))
+            st.metric("Total de registros", len(st.session_state.df))
             st.metric("Período analisado", f"{df['mes_ano'].iloc[0]} a {df['mes_ano'].iloc[-1]}")
             st.metric(f"Total consumido ({unidade})", f"{formatar_valor(df['consumo'].sum())}")
         
@@ -432,13 +829,17 @@ def main():
             min_value=min_date,
             max_value=max_date,
             value=(min_date, max_date),
-            format="MM/YYYY"
+            format="MM/YYYY",
+            key="intervalo_datas"
         )
         
         # Filtrar dados pelo intervalo selecionado
         filtered_df = df[(df['data'].dt.date >= date_range[0]) & (df['data'].dt.date <= date_range[1])]
         
         if not filtered_df.empty:
+            # Previsão sobreposta quando há uma única unidade e o período chega ao último mês
+            mostrar_previsao = len(unidades_consumidoras) == 1 and date_range[1] == max_date
+            
             # Gráficos de linha do tempo
             st.subheader(f"Evolução do Consumo de {tipo_medicao.capitalize()} ao Longo do Tempo")
             consumo_fig = criar_grafico_timeline(
@@ -446,7 +847,9 @@ def main():
                 'consumo', 
                 f"Consumo de {tipo_medicao.capitalize()} ({unidade})", 
                 f"Consumo ({unidade})",
-                cores_por_ano
+                cores_por_ano,
+                anomalias_geral,
+                filtrar_previsao(previsoes, unidades_consumidoras[0], 'consumo') if mostrar_previsao else None
             )
             st.plotly_chart(consumo_fig, width='stretch')
             st.caption("Use os botões acima do gráfico para selecionar períodos específicos.")
@@ -457,7 +860,9 @@ def main():
                 'valor', 
                 "Valor das Faturas (R$)", 
                 "Valor (R$)",
-                cores_por_ano
+                cores_por_ano,
+                anomalias_geral,
+                filtrar_previsao(previsoes, unidades_consumidoras[0], 'valor') if mostrar_previsao else None
             )
             st.plotly_chart(valor_fig, width='stretch')
             st.caption("Use os botões acima do gráfico para selecionar períodos específicos.")
@@ -470,6 +875,14 @@ def main():
             - **Clique na legenda** para mostrar/ocultar anos específicos
 
             """)
+
+            with st.expander("Exportar dados do período filtrado"):
+                exibir_botoes_exportacao(
+                    filtered_df,
+                    f"faturas_{date_range[0]:%Y-%m}_{date_range[1]:%Y-%m}",
+                    "exportar_linha_tempo",
+                    COLUNAS_EXPORTACAO_PERIODO
+                )
         else:
             st.warning("Nenhum dado encontrado para o período selecionado.")
     
@@ -479,7 +892,7 @@ def main():
         if 'dados_carregados' not in st.session_state or not st.session_state.dados_carregados:
             st.warning("⚠️ Nenhum dado carregado. Por favor, volte à aba 'Introdução' para carregar dados.")
             st.stop()
-        df = st.session_state.df
+        df = df_geral
         tipo_conta = st.session_state.tipo_conta
         
         st.header("Análise por Período Específico")
@@ -547,7 +960,8 @@ def main():
                     'consumo',
                     f"Consumo de {tipo_medicao.capitalize()} ({unidade})",
                     f"Consumo ({unidade})",
-                    cores_por_ano
+                    cores_por_ano,
+                    anomalias_geral
                 )
                 st.plotly_chart(consumo_periodo_fig, width='stretch')
                 
@@ -557,7 +971,8 @@ def main():
                     'valor',
                     "Valor das Faturas (R$)",
                     "Valor (R$)",
-                    cores_por_ano
+                    cores_por_ano,
+                    anomalias_geral
                 )
                 st.plotly_chart(valor_periodo_fig, width='stretch')
                 st.markdown("""
@@ -573,6 +988,12 @@ def main():
                 # Dados detalhados
                 with st.expander("Visualizar dados detalhados do período (tabela bruta)"):
                     st.dataframe(periodo_df[['mes_ano','consumo', 'valor']])
+                    exibir_botoes_exportacao(
+                        periodo_df,
+                        f"faturas_{data_inicial:%Y-%m}_{data_final:%Y-%m}",
+                        "exportar_periodo",
+                        COLUNAS_EXPORTACAO_PERIODO
+                    )
 
     # Aba 4: Comparações
     with tab4:
@@ -580,7 +1001,7 @@ def main():
         if 'dados_carregados' not in st.session_state or not st.session_state.dados_carregados:
             st.warning("⚠️ Nenhum dado carregado. Por favor, volte à aba 'Introdução' para carregar dados.")
             st.stop()
-        df = st.session_state.df
+        df = df_geral
         tipo_conta = st.session_state.tipo_conta
 
         st.header("Comparações de Consumo e Valores")
@@ -589,7 +1010,8 @@ def main():
         visualization_type = st.radio(
             "Escolha o tipo de visualização:",
             ["Comparação de Consumo por Ano", "Comparação de Valores por Ano", "Consumo x Valor"],
-            horizontal=True
+            horizontal=True,
+            key="tipo_visualizacao"
         )
         
         if visualization_type in ["Comparação de Consumo por Ano", "Comparação de Valores por Ano"]:
@@ -597,7 +1019,8 @@ def main():
             anos_para_comparar = st.multiselect(
                 "Selecione anos para comparação:",
                 anos,
-                default=anos[-2:] if len(anos) >= 2 else anos
+                default=anos[-2:] if len(anos) >= 2 else anos,
+                key="anos_para_comparar"
             )
             
             if len(anos_para_comparar) < 2:
@@ -628,25 +1051,23 @@ def main():
                 
                 # Tabela comparativa por mês
                 with st.expander("Visualizar tabela comparativa"):
-                    comp_data = []
-                    for mes in range(1, 13):
-                        row = {'Mês': MESES_PT[mes]}
-                        for ano in anos_para_comparar:
-                            filtered = df[(df['ano'] == ano) & (df['mes'] == mes)]
-                            if visualization_type == "Comparação de Consumo por Ano":
-                                if not filtered.empty:
-                                    row[f'Consumo {ano}'] = f"{filtered['consumo'].values[0]:,.1f} {unidade}".replace(',', '.')
-                                else:
-                                    row[f'Consumo {ano}'] = "N/A"
-                            else:
-                                if not filtered.empty:
-                                    row[f'Valor {ano}'] = formatar_valor(filtered['valor'].values[0])
-                                else:
-                                    row[f'Valor {ano}'] = "N/A"
-                        comp_data.append(row)
+                    if visualization_type == "Comparação de Consumo por Ano":
+                        coluna_comp, rotulo_comp = 'consumo', 'Consumo'
+                        formatar = lambda v: f"{v:,.1f} {unidade}".replace(',', '.')
+                    else:
+                        coluna_comp, rotulo_comp = 'valor', 'Valor'
+                        formatar = formatar_valor
                     
-                    comp_df = pd.DataFrame(comp_data)
-                    st.dataframe(comp_df, width='stretch')
+                    comp_df = montar_tabela_comparativa(df, anos_para_comparar, coluna_comp, rotulo_comp)
+                    comp_exibicao = comp_df.copy()
+                    for coluna in comp_exibicao.columns[1:]:
+                        comp_exibicao[coluna] = comp_exibicao[coluna].map(lambda v: formatar(v) if pd.notna(v) else "N/A")
+                    st.dataframe(comp_exibicao, width='stretch')
+                    exibir_botoes_exportacao(
+                        comp_df,
+                        f"comparativo_{coluna_comp}_{'_'.join(str(ano) for ano in anos_para_comparar)}",
+                        "exportar_comparativo"
+                    )
         
         else:  # Consumo x Valor
             st.subheader("Relação entre Consumo e Valor")
@@ -729,6 +1150,167 @@ def main():
             poderia levar a conclusões imprecisas.
             """)
 
+    # Aba 5: Anomalias
+    with tab5:
+        # Confirmação de que os dados estão carregados corretamente
+        if 'dados_carregados' not in st.session_state or not st.session_state.dados_carregados:
+            st.warning("⚠️ Nenhum dado carregado. Por favor, volte à aba 'Introdução' para carregar dados.")
+            st.stop()
+        df = st.session_state.df
+
+        st.header("Detecção de Anomalias")
+        st.markdown("""
+        Cada fatura é comparada com a linha de base da própria unidade consumidora: a mediana do mesmo mês
+        nos anos anteriores (ou, sem esse histórico, a média dos últimos 12 meses). São destacadas as faturas
+        cujo consumo, valor ou valor por unidade consumida se afastam muito dessa base (z-score, medido pela
+        oscilação habitual da unidade em torno da mesma base), e as que variam bruscamente em relação ao mesmo
+        mês do ano anterior.
+        """)
+
+        col1, col2 = st.columns(2)
+        with col1:
+            st.slider("Limiar de z-score", min_value=2.0, max_value=6.0, value=LIMIAR_Z_ANOMALIA, step=0.5, key="limiar_anomalia")
+        with col2:
+            st.slider("Variação anual máxima (%)", min_value=10, max_value=300, value=int(LIMIAR_VARIACAO_ANUAL * 100), step=10, key="limiar_variacao_anual")
+
+        unidades = df['uc'].nunique() if 'uc' in df.columns else 1
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Unidades analisadas", unidades)
+        with col2:
+            st.metric("Faturas anômalas", len(anomalias))
+        with col3:
+            st.metric("Unidades com anomalias", anomalias['uc'].nunique())
+
+        if anomalias.empty:
+            st.success("Nenhuma anomalia encontrada com os limiares selecionados.")
+        else:
+            st.subheader("Ranking de anomalias")
+            tabela_anomalias = anomalias[[
+                'uc', 'mes_ano', 'consumo', 'esperado_consumo', 'valor', 'esperado_valor',
+                'z_consumo', 'z_valor', 'z_razao', 'var_anual_consumo', 'var_anual_valor', 'pontuacao', 'motivo'
+            ]]
+            st.dataframe(
+                tabela_anomalias.rename(columns={
+                    'uc': 'Unidade', 'mes_ano': 'Mês/Ano', 'consumo': f'Consumo ({unidade})',
+                    'esperado_consumo': f'Consumo esperado ({unidade})', 'valor': 'Valor (R$)',
+                    'esperado_valor': 'Valor esperado (R$)', 'z_consumo': 'z Consumo', 'z_valor': 'z Valor',
+                    'z_razao': 'z Valor/Consumo', 'var_anual_consumo': 'Variação anual consumo',
+                    'var_anual_valor': 'Variação anual valor', 'pontuacao': 'Pontuação', 'motivo': 'Motivo'
+                }),
+                width='stretch',
+                hide_index=True
+            )
+            exibir_botoes_exportacao(tabela_anomalias, "anomalias", "exportar_anomalias")
+
+            # Gráficos da unidade selecionada (unidades ordenadas pela maior pontuação)
+            st.subheader("Linha do tempo por unidade")
+            unidade_selecionada = st.selectbox(
+                "Unidade consumidora",
+                anomalias['uc'].unique(),
+                key="uc_anomalia"
+            )
+            df_uc = df[df['uc'] == unidade_selecionada] if 'uc' in df.columns else df
+            st.plotly_chart(
+                criar_grafico_timeline(
+                    df_uc,
+                    'consumo',
+                    f"Consumo da unidade {unidade_selecionada} ({unidade})",
+                    f"Consumo ({unidade})",
+                    cores_por_ano,
+                    anomalias
+                ),
+                width='stretch'
+            )
+            st.plotly_chart(
+                criar_grafico_timeline(
+                    df_uc,
+                    'valor',
+                    f"Valor das faturas da unidade {unidade_selecionada} (R$)",
+                    "Valor (R$)",
+                    cores_por_ano,
+                    anomalias
+                ),
+                width='stretch'
+            )
+            st.caption("Os círculos vermelhos destacam as faturas anômalas. Passe o mouse sobre eles para ver o motivo.")
+
+    # Aba 6: Previsão
+    with tab6:
+        # Confirmação de que os dados estão carregados corretamente
+        if 'dados_carregados' not in st.session_state or not st.session_state.dados_carregados:
+            st.warning("⚠️ Nenhum dado carregado. Por favor, volte à aba 'Introdução' para carregar dados.")
+            st.stop()
+        df = st.session_state.df
+
+        st.header(f"Previsão para os Próximos {HORIZONTE_PREVISAO} Meses")
+        st.markdown(f"""
+        Para cada unidade consumidora é ajustado um modelo de suavização exponencial (com tendência amortecida
+        e, quando há pelo menos 24 meses com fatura, sazonalidade anual) para o consumo e para o valor das faturas.
+        Os modelos ficam guardados: ao carregar dados novos, apenas as unidades cujo histórico mudou são reajustadas.
+        A faixa sombreada nos gráficos indica o intervalo de {NIVEL_CONFIANCA:.0%} da previsão.
+        """)
+
+        st.toggle("Calcular previsões", key="calcular_previsoes")
+
+        if previsoes is None:
+            st.info("👆 Ative o cálculo das previsões. Com muitas unidades, o primeiro ajuste pode levar alguns minutos.")
+        elif previsoes.empty:
+            st.warning("Não há histórico suficiente (mínimo de 12 meses com fatura por unidade) para calcular previsões.")
+        else:
+            st.metric("Unidades previstas", previsoes['uc'].nunique())
+            st.caption(
+                f"Previsões calculadas em {resumo_previsao['calculado_em']:%d/%m/%Y %H:%M}: "
+                f"{resumo_previsao['ajustados']} modelo(s) ajustado(s) e "
+                f"{resumo_previsao['reaproveitados']} reaproveitado(s) de cálculos anteriores."
+            )
+            if resumo_previsao['historico_insuficiente'] or resumo_previsao['falhas']:
+                st.caption(
+                    f"{resumo_previsao['historico_insuficiente']} unidade(s) sem histórico suficiente e "
+                    f"{resumo_previsao['falhas']} modelo(s) que não convergiram ficaram de fora."
+                )
+
+            # Totais previstos por mês (soma das unidades) para o orçamento
+            st.subheader("Totais previstos por mês")
+            totais = previsoes.pivot_table(index='data', columns='metrica', values='previsao', aggfunc='sum').rename_axis(columns=None).reset_index()
+            totais.insert(0, 'Mês/Ano', [f"{MESES_ABREV_PT[d.month]}/{d.year}" for d in totais['data']])
+            totais = totais.drop(columns='data').rename(columns={'consumo': f'Consumo previsto ({unidade})', 'valor': 'Valor previsto (R$)'})
+            st.dataframe(totais, width='stretch', hide_index=True)
+            exibir_botoes_exportacao(totais, "previsao_totais", "exportar_previsao_totais")
+
+            with st.expander("Exportar previsões por unidade"):
+                exibir_botoes_exportacao(previsoes, "previsao_unidades", "exportar_previsao_unidades")
+
+            # Gráficos da unidade selecionada com a faixa de previsão
+            st.subheader("Linha do tempo com previsão")
+            uc_previsao = st.selectbox("Unidade consumidora", sorted(previsoes['uc'].unique()), key="uc_previsao")
+            df_uc = df[df['uc'] == uc_previsao] if 'uc' in df.columns else df
+            st.plotly_chart(
+                criar_grafico_timeline(
+                    df_uc,
+                    'consumo',
+                    f"Consumo da unidade {uc_previsao} ({unidade})",
+                    f"Consumo ({unidade})",
+                    cores_por_ano,
+                    anomalias,
+                    filtrar_previsao(previsoes, uc_previsao, 'consumo')
+                ),
+                width='stretch'
+            )
+            st.plotly_chart(
+                criar_grafico_timeline(
+                    df_uc,
+                    'valor',
+                    f"Valor das faturas da unidade {uc_previsao} (R$)",
+                    "Valor (R$)",
+                    cores_por_ano,
+                    anomalias,
+                    filtrar_previsao(previsoes, uc_previsao, 'valor')
+                ),
+                width='stretch'
+            )
+            st.caption("A linha tracejada mostra a previsão e a faixa sombreada o seu intervalo de confiança.")
+
 # Executar o aplicativo
 if __name__ == "__main__":
     main()
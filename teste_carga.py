@@ -0,0 +1,219 @@
+"""
+Teste de carga do dashboard com várias sessões simultâneas.
+
+Cada sessão roda em um processo próprio usando o AppTest do Streamlit (que não
+pode ser usado por várias threads ao mesmo tempo), carrega um conjunto de dados
+sintético e executa uma sequência de interações: mover o slider de datas, trocar
+o período analisado e alternar os anos/tipos de comparação. Ao final são
+exibidas as latências de rerun (p50/p95/p99), a do upload, a vazão e a memória
+de cada processo.
+
+Limitação: como cada sessão é um processo isolado, com caches próprios, o teste
+mede a disputa por CPU entre sessões simultâneas, mas não o compartilhamento de
+st.cache_data/st.cache_resource nem a disputa por threads e GIL dentro de um
+único servidor `streamlit run`.
+
+Uso:
+    python teste_carga.py --sessoes 8 --interacoes 30 --anos 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+CAMINHO_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streamlit_app.py')
+TIPOS_CONTA = ('Conta de água(CAESB)', 'Conta de energia(CEB/Neoenergia)')
+TIPOS_VISUALIZACAO = ("Comparação de Consumo por Ano", "Comparação de Valores por Ano", "Consumo x Valor")
+
+
+# Função para gerar um arquivo CSV sintético, no mesmo formato entregue pelo st.file_uploader
+def gerar_arquivo_sintetico(sessao, rng, num_anos, ano_final=2024):
+    from streamlit.proto.Common_pb2 import FileURLs
+    from streamlit.runtime.uploaded_file_manager import UploadedFile, UploadedFileRec
+
+    anos = np.repeat(np.arange(ano_final - num_anos + 1, ano_final + 1), 12)
+    meses = np.tile(np.arange(1, 13), num_anos)
+    fator_sazonal = 1 + 0.3 * np.sin((meses - 1) * np.pi / 6)
+    consumo = (rng.integers(10, 550, size=len(meses)) * fator_sazonal).round()
+    valor = (consumo * rng.uniform(1.5, 2.5, size=len(meses))).round(2)
+
+    conteudo = pd.DataFrame({'mes': meses, 'ano': anos, 'valor': valor, 'consumo': consumo}).to_csv(index=False)
+    registro = UploadedFileRec(
+        file_id=f'sessao-{sessao}',
+        name=f'dados_sinteticos_{sessao}.csv',
+        type='text/csv',
+        data=conteudo.encode('utf-8')
+    )
+    return UploadedFile(registro, FileURLs())
+
+
+# Função para medir a memória máxima do processo atual (em MB)
+def memoria_maxima_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return float('nan')
+    maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss é informado em bytes no macOS e em kilobytes no Linux
+    return maximo / 2**20 if sys.platform == 'darwin' else maximo / 2**10
+
+
+# Funções que simulam as interações do usuário (cada uma gera um rerun)
+def mover_slider(at, rng):
+    opcoes = sorted(at.session_state['df']['data'].dt.date.unique())
+    inicio, fim = sorted(rng.choice(len(opcoes), size=2, replace=False))
+    at.slider(key='intervalo_datas').set_value((opcoes[inicio], opcoes[fim]))
+
+def trocar_periodo(at, rng):
+    anos = sorted(at.session_state['df']['ano'].unique())
+    ano_inicial, ano_final = sorted(rng.choice(anos, size=2))
+    at.selectbox(key='ano_inicial').set_value(ano_inicial)
+    at.selectbox(key='ano_final').set_value(ano_final)
+
+def trocar_comparacao(at, rng):
+    at.radio(key='tipo_visualizacao').set_value(TIPOS_VISUALIZACAO[rng.integers(0, 2)])
+    # O seletor de anos só existe quando a comparação anual já está na tela
+    if at.multiselect:
+        anos = sorted(at.session_state['df']['ano'].unique())
+        quantidade = rng.integers(2, len(anos) + 1)
+        at.multiselect(key='anos_para_comparar').set_value(sorted(rng.choice(anos, size=quantidade, replace=False)))
+
+def alternar_dispersao(at, rng):
+    at.radio(key='tipo_visualizacao').set_value("Consumo x Valor")
+
+INTERACOES = [mover_slider, trocar_periodo, trocar_comparacao, alternar_dispersao]
+
+
+# Função executada em cada processo: uma sessão completa do dashboard
+def executar_sessao(sessao, num_interacoes, num_anos, inicio, timeout):
+    from streamlit.testing.v1 import AppTest
+    from streamlit_app import processar_dados
+
+    rng = np.random.default_rng(sessao)
+    tipo_conta = TIPOS_CONTA[sessao % len(TIPOS_CONTA)]
+    latencias = []
+    erros = 0
+
+    def rerun(at):
+        nonlocal erros
+        t0 = time.perf_counter()
+        at.run(timeout=timeout)
+        latencias.append(time.perf_counter() - t0)
+        erros += len(at.exception)
+
+    # Aguarda o horário combinado para que todas as sessões comecem juntas
+    time.sleep(max(0, inicio - time.time()))
+    t_inicio = time.time()
+
+    at = AppTest.from_file(CAMINHO_APP, default_timeout=timeout)
+    rerun(at)
+    at.selectbox(key='select_conta').set_value(tipo_conta)
+    rerun(at)
+
+    # O AppTest não simula o file_uploader: o arquivo sintético passa pelo mesmo
+    # processamento do upload e o resultado é colocado na sessão. A latência do upload
+    # inclui o processamento do arquivo e o rerun seguinte.
+    arquivo = gerar_arquivo_sintetico(sessao, rng, num_anos)
+    t0 = time.perf_counter()
+    at.session_state['df'] = processar_dados(arquivo, tipo_conta)
+    at.session_state['tipo_conta'] = tipo_conta
+    at.session_state['dados_carregados'] = True
+    at.session_state['fonte_dados'] = 'arquivo'
+    rerun(at)
+    latencia_upload = time.perf_counter() - t0
+    latencias[-1] = latencia_upload
+
+    for _ in range(num_interacoes):
+        interacao = INTERACOES[rng.integers(0, len(INTERACOES))]
+        try:
+            interacao(at, rng)
+        except Exception:
+            erros += 1
+            continue
+        rerun(at)
+
+    return {
+        'sessao': sessao,
+        'pid': os.getpid(),
+        'reruns': len(latencias),
+        'erros': erros,
+        'latencias': latencias,
+        'latencia_upload': latencia_upload,
+        'inicio': t_inicio,
+        'fim': time.time(),
+        'memoria_max_mb': memoria_maxima_mb(),
+    }
+
+
+def resumir(resultados):
+    latencias = np.concatenate([r['latencias'] for r in resultados]) * 1000
+    duracao = max(r['fim'] for r in resultados) - min(r['inicio'] for r in resultados)
+    p50, p95, p99 = np.percentile(latencias, [50, 95, 99])
+    uploads = np.array([r['latencia_upload'] for r in resultados]) * 1000
+    return {
+        'sessoes': len(resultados),
+        'reruns': int(len(latencias)),
+        'erros': int(sum(r['erros'] for r in resultados)),
+        'duracao_s': duracao,
+        'vazao_reruns_s': len(latencias) / duracao,
+        'latencia_p50_ms': p50,
+        'latencia_p95_ms': p95,
+        'latencia_p99_ms': p99,
+        'latencia_max_ms': latencias.max(),
+        'upload_p50_ms': np.percentile(uploads, 50),
+        'upload_max_ms': uploads.max(),
+        'memoria_max_mb': max(r['memoria_max_mb'] for r in resultados),
+    }
+
+
+def exibir_relatorio(resultados, resumo):
+    print(f"{'Sessão':>6} {'PID':>8} {'Reruns':>7} {'Erros':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} {'Memória (MB)':>13}")
+    for r in sorted(resultados, key=lambda r: r['sessao']):
+        p50, p95 = np.percentile(np.array(r['latencias']) * 1000, [50, 95])
+        print(f"{r['sessao']:>6} {r['pid']:>8} {r['reruns']:>7} {r['erros']:>6} {p50:>9.1f} {p95:>9.1f} {r['memoria_max_mb']:>13.1f}")
+    print()
+    print(f"Sessões simultâneas: {resumo['sessoes']}")
+    print(f"Reruns: {resumo['reruns']} ({resumo['erros']} erros) em {resumo['duracao_s']:.1f} s")
+    print(f"Vazão: {resumo['vazao_reruns_s']:.2f} reruns/s")
+    print(f"Latência de rerun: p50 {resumo['latencia_p50_ms']:.1f} ms | p95 {resumo['latencia_p95_ms']:.1f} ms | "
+          f"p99 {resumo['latencia_p99_ms']:.1f} ms | máx {resumo['latencia_max_ms']:.1f} ms")
+    print(f"Upload (processamento + rerun): p50 {resumo['upload_p50_ms']:.1f} ms | máx {resumo['upload_max_ms']:.1f} ms")
+    print(f"Memória máxima por processo: {resumo['memoria_max_mb']:.1f} MB")
+    print()
+    print("Atenção: cada sessão rodou em um processo isolado, com caches próprios. Os números não incluem")
+    print("o compartilhamento de cache nem a disputa por threads/GIL de um único servidor `streamlit run`.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do dashboard com sessões simultâneas (AppTest).")
+    parser.add_argument('--sessoes', type=int, default=4, help="número de sessões simultâneas")
+    parser.add_argument('--interacoes', type=int, default=20, help="interações por sessão")
+    parser.add_argument('--anos', type=int, default=3, help="anos de dados sintéticos por sessão")
+    parser.add_argument('--timeout', type=float, default=60, help="tempo máximo de cada rerun (s)")
+    parser.add_argument('--json', help="caminho para salvar o resumo em JSON")
+    args = parser.parse_args()
+
+    # Margem para que todos os processos estejam prontos antes do início
+    inicio = time.time() + 2 + 0.25 * args.sessoes
+    with ProcessPoolExecutor(max_workers=args.sessoes) as executor:
+        futuros = [
+            executor.submit(executar_sessao, sessao, args.interacoes, args.anos, inicio, args.timeout)
+            for sessao in range(args.sessoes)
+        ]
+        resultados = [futuro.result() for futuro in futuros]
+
+    resumo = resumir(resultados)
+    exibir_relatorio(resultados, resumo)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as arquivo:
+            json.dump(resumo, arquivo, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from streamlit_app import detectar_anomalias
+
+
+def criar_faturas(rng):
+    linhas = []
+    for uc, nivel, ruido in [('a', 100, 0.02), ('b', 300, 0.02), ('plana', 50, 0.0)]:
+        for ano in range(2020, 2024):
+            for mes in range(1, 13):
+                consumo = nivel * (1 + 0.3 * np.sin((mes - 1) * np.pi / 6)) * rng.normal(1, ruido)
+                if uc == 'plana':
+                    consumo = nivel
+                linhas.append((uc, mes, ano, round(consumo, 1), round(consumo * 2, 2)))
+    df = pd.DataFrame(linhas, columns=['uc', 'mes', 'ano', 'consumo', 'valor'])
+    df['data'] = pd.to_datetime(dict(year=df['ano'], month=df['mes'], day=1))
+    df['mes_ano'] = df['mes'].astype(str) + '/' + df['ano'].astype(str)
+    return df
+
+
+def test_pico_injetado_fica_em_primeiro_e_unidade_plana_sem_alertas():
+    df = criar_faturas(np.random.default_rng(0))
+    pico = df[(df['uc'] == 'b') & (df['ano'] == 2023) & (df['mes'] == 6)].index[0]
+    df.loc[pico, 'consumo'] *= 4
+
+    # A ordem das linhas não deve influenciar as linhas de base
+    anomalias = detectar_anomalias(df.sample(frac=1, random_state=1))
+
+    assert anomalias.index[0] == pico
+    assert anomalias.loc[pico, 'anomalia_consumo']
+    assert 'plana' not in set(anomalias['uc'])
+
+
+def test_poucos_alertas_em_dados_apenas_com_ruido():
+    rng = np.random.default_rng(0)
+    unidades, meses = 300, 60
+    datas = pd.date_range('2019-01-01', periods=meses, freq='MS')
+    df = pd.DataFrame({
+        'uc': np.repeat(np.arange(unidades).astype(str), meses),
+        'data': np.tile(datas, unidades),
+        'consumo': rng.normal(100, 10, unidades * meses),
+        'valor': rng.normal(200, 20, unidades * meses),
+    })
+    df['mes'] = df['data'].dt.month
+    df['ano'] = df['data'].dt.year
+    df['mes_ano'] = df['mes'].astype(str) + '/' + df['ano'].astype(str)
+
+    # Com quatro critérios no limiar de 3 desvios, cerca de 1% das faturas passa por acaso
+    assert len(detectar_anomalias(df)) / len(df) < 0.03
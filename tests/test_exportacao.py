@@ -0,0 +1,36 @@
+import pandas as pd
+from openpyxl import load_workbook
+
+from streamlit_app import exportar_parquet, exportar_xlsx
+
+
+def test_xlsx_grava_formato_decimal_em_cada_celula():
+    df = pd.DataFrame({
+        'mes_ano': ['Jan/2023', 'Fev/2023', 'Mar/2023'],
+        'consumo': [10, 12, 11],
+        'valor': [644.39, None, 1234.5],
+    })
+    ws = load_workbook(exportar_xlsx(df)).active
+
+    assert ws['C2'].number_format == '#,##0.00'
+    assert ws['C2'].value == 644.39
+    assert ws['C3'].value is None
+    assert ws['C4'].number_format == '#,##0.00'
+    assert ws['B2'].number_format == 'General'
+    assert ws['A2'].value == 'Jan/2023'
+
+
+def test_parquet_aceita_colunas_de_texto_do_tipo_object():
+    import pyarrow.parquet as pq
+
+    df = pd.DataFrame({
+        'mes_ano': pd.Series(['Jan/2023', 'Fev/2023'], dtype=object),
+        'consumo': [10.0, 12.5],
+        'unidade': pd.Series(['m³', 'm³'], dtype=object),
+        'observacao': pd.Series([None, None], dtype=object),
+    })
+    tabela = pq.read_table(exportar_parquet(df, ['mes_ano', 'consumo', 'unidade', 'observacao']))
+
+    assert tabela.column('mes_ano').to_pylist() == ['Jan/2023', 'Fev/2023']
+    assert tabela.column('consumo').to_pylist() == [10.0, 12.5]
+    assert tabela.column('observacao').to_pylist() == [None, None]
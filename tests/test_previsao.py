@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+from previsao import CacheModelos, prever_unidades
+
+
+def criar_faturas(rng, unidades=('a', 'b', 'c')):
+    linhas = []
+    for i, uc in enumerate(unidades):
+        for ano in range(2021, 2024):
+            for mes in range(1, 13):
+                consumo = 100 * (i + 1) * (1 + 0.3 * np.sin((mes - 1) * np.pi / 6)) * rng.normal(1, 0.05)
+                linhas.append((uc, mes, ano, round(consumo, 1), round(consumo * 2, 2)))
+    df = pd.DataFrame(linhas, columns=['uc', 'mes', 'ano', 'consumo', 'valor'])
+    df['data'] = pd.to_datetime(dict(year=df['ano'], month=df['mes'], day=1))
+    return df
+
+
+def test_segunda_chamada_reaproveita_e_so_a_unidade_alterada_e_reajustada():
+    df = criar_faturas(np.random.default_rng(0))
+    cache = CacheModelos()
+
+    _, resumo = prever_unidades(df, cache)
+    assert resumo['ajustados'] == 6 and resumo['reaproveitados'] == 0
+
+    previsoes, resumo = prever_unidades(df, cache)
+    assert resumo['ajustados'] == 0 and resumo['reaproveitados'] == 6
+    assert set(previsoes['uc']) == {'a', 'b', 'c'}
+
+    # Um mês novo apenas na unidade 'b': só o consumo e o valor dela são reajustados
+    novo_mes = pd.DataFrame([('b', 1, 2024, 210.0, 420.0, pd.Timestamp('2024-01-01'))], columns=df.columns)
+    _, resumo = prever_unidades(pd.concat([df, novo_mes], ignore_index=True), cache)
+    assert resumo['ajustados'] == 2 and resumo['reaproveitados'] == 4
+    assert len(cache) == 6
+
+
+def test_cache_guarda_apenas_a_impressao_mais_recente_e_respeita_o_limite():
+    cache = CacheModelos(max_entradas=2)
+    cache.guardar('a', 'consumo', 'v1', np.zeros(3))
+    cache.guardar('a', 'consumo', 'v2', np.ones(3))
+    assert cache.obter('a', 'consumo', 'v1') is None
+    assert cache.obter('a', 'consumo', 'v2') is not None
+
+    cache.guardar('b', 'consumo', 'v1', np.zeros(3))
+    cache.guardar('c', 'consumo', 'v1', np.zeros(3))
+    assert len(cache) == 2
+    assert cache.obter('a', 'consumo', 'v2') is None
+
+
+def test_meses_interpolados_nao_contam_como_historico():
+    df = criar_faturas(np.random.default_rng(0), unidades=('a',))
+    # Duas faturas com 12 meses de intervalo viram 13 meses após a interpolação
+    esparsa = pd.DataFrame({
+        'uc': 'esparsa', 'mes': 1, 'ano': [2022, 2023], 'consumo': [200.0, 210.0], 'valor': [400.0, 420.0],
+        'data': pd.to_datetime(['2022-01-01', '2023-01-01']),
+    })
+    previsoes, resumo = prever_unidades(pd.concat([df, esparsa], ignore_index=True), CacheModelos())
+
+    assert resumo['historico_insuficiente'] == 1
+    assert set(previsoes['uc']) == {'a'}
+
+
+def test_pool_quebrado_e_recriado_e_o_calculo_refeito():
+    import os
+    from concurrent.futures.process import BrokenProcessPool
+
+    import pytest
+
+    from streamlit_app import calcular_previsoes, obter_executor_previsao
+
+    # Um processo do pool encerrado abruptamente inutiliza o pool inteiro
+    executor = obter_executor_previsao()
+    with pytest.raises(BrokenProcessPool):
+        executor.submit(os._exit, 1).result()
+
+    # Com mais séries que MAX_SERIES_SEM_POOL, o cálculo passa pelo pool
+    df = criar_faturas(np.random.default_rng(0), unidades=('a', 'b', 'c', 'd', 'e'))
+    previsoes, _ = calcular_previsoes(df)
+
+    assert set(previsoes['uc']) == {'a', 'b', 'c', 'd', 'e'}
+    assert obter_executor_previsao() is not executor
+    obter_executor_previsao().shutdown()
+    obter_executor_previsao.clear()
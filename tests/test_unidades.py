@@ -0,0 +1,18 @@
+import pandas as pd
+
+from streamlit_app import montar_tabela_comparativa, somar_unidades
+
+
+def test_varias_unidades_sao_somadas_no_mes():
+    datas = pd.to_datetime(['2023-01-01', '2023-02-01'])
+    df = pd.concat([
+        pd.DataFrame({'uc': uc, 'data': datas, 'mes': [1, 2], 'ano': 2023, 'consumo': consumo, 'valor': consumo * 2.0})
+        for uc, consumo in [('A', 100), ('B', 900)]
+    ], ignore_index=True)
+
+    soma = somar_unidades(df)
+    assert soma['consumo'].tolist() == [1000, 1000]
+    assert soma['valor'].tolist() == [2000.0, 2000.0]
+
+    tabela = montar_tabela_comparativa(df, [2023], 'consumo', 'Consumo')
+    assert tabela.loc[0, 'Consumo 2023'] == 1000